@@ -9,7 +9,7 @@
 # 	- Send ROS msg containing face area, key points and face pose and unique ID for each detected face
 #
 #	Current Workarounds:
-#	- Tracking not implemented (no unique face id provided)
+#	- Tracking only used to skip MTCNN between detections (no unique face id provided)
 #	- 3D coodinates not implemented (face region used as distance measure)
 #	- Function for Face Recognition also implemented in this modue for simplicity (to be put into anothe rmodule)
 #	- No ROS communication
@@ -19,11 +19,12 @@ import sys
 import numpy as np
 import cv2
 import os
-from scipy import misc
 import time
 import re
-import pickle
-from thread import start_new_thread
+import queue
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 # Import for Neural Networks
 import tensorflow as tf
@@ -38,118 +39,243 @@ EXPECT_SIZE = 160
 # Define bounding box size for proximity detetcion of faces (increase to make distance smaller)
 FACE_AREA = 1500  # Face area for approx. 1.5m distance
 
+# Maximum number of queued frames run through MTCNN at once (4 for low latency, 16 for throughput).
+# Batching and tracking exclude each other, frames are only batched if DETECTION_INTERVAL is 1.
+MTCNN_BATCH_SIZE = 4
+
+# Run full MTCNN detection every DETECTION_INTERVAL frames, faces are tracked on the frames in between
+DETECTION_INTERVAL = 5
+
+# Cache of the quantized FaceNet, delete it to convert the model again
+FACENET_TFLITE_FILE = 'models/facenet/facenet_quantized.tflite'
+
+# Minimum cosine similarity between FP32 and quantized embeddings of the check faces. The reference
+# embeddings were calculated with the FP32 model, so the quantized model is rejected below this value.
+QUANTIZATION_MIN_SIMILARITY = 0.98
+
+# Pattern of tensorflow checkpoint files, the second group is the training step
+CKPT_FILE_PATTERN = re.compile(r'(^model-[\w\- ]+\.ckpt-(\d+))')
+
+# Pending requests to recognize the closest face, each request is a queue the face name is passed back in
+recognition_requests = queue.Queue()
+
+
+## Helper Function to convert the MTCNN output of one image
+#
+#  @param bbs Bounding boxes as returned by MTCNN
+#  @param lms Landmarks as returned by MTCNN (x coordinates in rows 0-4, y coordinates in rows 5-9)
+#  @return Bounding boxes bb as float array of rows (x1, y1, x2, y2) and landmark points for eyes,
+#          nose and mouth edges as array of shape (faces, 5, 2).
+def convert_mtcnn_result(bbs, lms):
+    if len(bbs) == 0:
+        return np.empty((0, 4)), np.empty((0, 5, 2))
+    boxes = np.asarray(bbs)[:, 0:4]
+    landmarks = np.reshape(lms, (2, 5, -1)).transpose(2, 1, 0)
+    return boxes, landmarks
+
 
 ## Function to do face detection and alignment on an image
 #
 #  Run face detection on the full input image using a MTCNN for Joint Detection and Alignment from here:
 #  https://github.com/pangyupo/mxnet_mtcnn_face_detection
-#  @param img The RGB image
+#  @param img The RGB image (3 channels)
 #  @return Bounding boxes bb and landmark points for eyes, nose and mouth edges.
 def detect_face_and_landmarks_mtcnn(img):
-    img = img[:, :, 0:3]
     bbs, lms = detect_face.detect_face(img, minsize, pnet, rnet, onet,
                                        threshold, factor)
+    return convert_mtcnn_result(bbs, lms)
+
+
+## Function to do face detection and alignment on a batch of images
+#
+#  Same as detect_face_and_landmarks_mtcnn but uses bulk_detect_face of MTCNN, which runs the
+#  candidates of all images through RNet and ONet in one batch each.
+#  @param imgs A list of RGB images (3 channels) of the same size
+#  @return A list containing bounding boxes and landmark points for each image.
+def detect_face_and_landmarks_mtcnn_bulk(imgs):
+    window_size_ratio = float(minsize) / min(imgs[0].shape[0:2])
+    results = detect_face.bulk_detect_face(imgs, window_size_ratio, pnet,
+                                           rnet, onet, threshold, factor)
+    detections = []
+    for result in results:
+        if result is None:
+            detections.append(convert_mtcnn_result([], []))
+        else:
+            detections.append(convert_mtcnn_result(*result))
+    return detections
+
+
+## Function to start tracking detected faces
+#
+#  Creates a MOSSE tracker for each bounding box, which is cheap enough to run on every frame.
+#  @param img The RGB image the faces were detected in
+#  @param bbs An array of bounding boxes of a face as (x1, y1, x2, y2)
+#  @return Returns a list containing a tracker for each face.
+def create_face_trackers(img, bbs):
+    trackers = []
+    for left, top, right, bottom in bbs:
+        tracker = cv2.TrackerMOSSE_create()
+        tracker.init(img, (float(left), float(top), float(right - left),
+                           float(bottom - top)))
+        trackers.append(tracker)
+    return trackers
+
+
+## Function to track faces in a new frame
+#
+#  MOSSE resizes its box to an optimal DFT size, so only the center of the tracked box is used.
+#  The faces keep the width and height they were detected with.
+#  @param img The RGB image
+#  @param trackers The trackers as returned by create_face_trackers
+#  @param bbs An array of the current bounding boxes of the faces as (x1, y1, x2, y2)
+#  @return Bounding boxes bb as float array of rows (x1, y1, x2, y2) or None if a face was lost.
+def track_faces(img, trackers, bbs):
     boxes = []
-    landmarks = []
-    face_index = 0
-    for r in bbs:
-        r = r.astype(int)
-        points = []
-        for i in range(5):
-            points.append((lms[i][face_index], lms[i + 5][face_index]))
-        landmarks.append(points)
-        boxes.append((r[0], r[1], r[2], r[3]))
-        face_index += 1
-    return boxes, landmarks
+    for tracker, (left, top, right, bottom) in zip(trackers, bbs):
+        ok, (x, y, w, h) = tracker.update(img)
+        if not ok:
+            return None
+        half_width = (right - left) / 2.0
+        half_height = (bottom - top) / 2.0
+        center_x = x + w / 2.0
+        center_y = y + h / 2.0
+        boxes.append((center_x - half_width, center_y - half_height,
+                      center_x + half_width, center_y + half_height))
+    return np.asarray(boxes, dtype=float).reshape(-1, 4)
 
 
 ## Function to align detected faces.
 #
-#  The current implementation crops the picture given a face region. 
+#  The current implementation crops the picture given a face region. Cropping and scaling is done in a
+#  single bilinear pass with sub-pixel precision, parts of the face region outside the image are black.
 #  We do not use actual alignment because performance increase for face recognition is marginal and only 
 #  slows down realtime performance as is also argued here:
 #  https://github.com/davidsandberg/facenet/issues/93
 #  @param img The RGB image
-#  @param bb The bounding box of a face as tuple (x1, y1, x2, y2)
+#  @param bb The bounding box of a face as (x1, y1, x2, y2)
 #  @return Returns the cropped face region.
 def align_face_mtcnn(img, bb):
-    assert isinstance(bb, tuple)
-    cropped = img[bb[1]:bb[3], bb[0]:bb[2], :]
-    scaled = misc.imresize(
-        cropped, (EXPECT_SIZE, EXPECT_SIZE), interp='bilinear')
+    assert len(bb) == 4
+    x1, y1, x2, y2 = [float(v) for v in bb]
+    # map the face region onto EXPECT_SIZE x EXPECT_SIZE with pixel centers aligned like cv2.resize
+    scale_x = EXPECT_SIZE / (x2 - x1)
+    scale_y = EXPECT_SIZE / (y2 - y1)
+    transform = np.array(
+        [[scale_x, 0, scale_x * (0.5 - x1) - 0.5],
+         [0, scale_y, scale_y * (0.5 - y1) - 0.5]])
+    scaled = cv2.warpAffine(
+        img, transform, (EXPECT_SIZE, EXPECT_SIZE), flags=cv2.INTER_LINEAR)
     return scaled
 
 
 ## Function to draw bounding boxes in a picture
 #
-#  Given an image, the bounding boxes for the corresponding face regions are drawn. Additionally a resize_factor
+#  Given an image, the bounding boxes for the corresponding face regions are drawn into the image. Additionally a resize_factor
 #  is used if the bounding boxes were calculated on a scaled version of the input image. Default value of the resize factor
 #  is 1, meaning bounding boxes were calculated on the same image size.
 #  @param img The RGB image
 #  @param bbs An array of bounding boxes of a face as tuple (x1, y1, x2, y2)
 #  @resize_factor factor to scale up bounding box size if calculated on different picture scale.
-#  @return Image overlayed with the bounding boxes.
 def draw_rects(img, bbs, resize_factor=1):
-    result = img.copy()
-    bbs = (np.array(bbs) / resize_factor).astype(int)
+    if resize_factor != 1:
+        bbs = np.asarray(bbs) / resize_factor
+    bbs = np.asarray(bbs, dtype=int).tolist()
     for left, top, right, bottom in bbs:
-        cv2.rectangle(result, (left, top), (right, bottom), (0, 255, 0), 2)
-    return result
+        cv2.rectangle(img, (left, top), (right, bottom), (0, 255, 0), 2)
 
 
 ## Function to draw feature points in a picture
 #
-#  Given an image, the feature points for the corresponding faces are drawn. Additionally a resize_factor
+#  Given an image, the feature points for the corresponding faces are drawn into the image. Additionally a resize_factor
 #  is used if the feature points were calculated on a scaled version of the input image. Default value of the 
 #  resize factor is 1, meaning the feature points were calculated on the same image size.
 #  @param img The RGB image
 #  @param points An array containing arrays of feature points of a face
 #  @resize_factor factor to scale up bounding box size if calculated on different picture scale.
-#  @return Image overlayed with the feature points
-def draw_landmarks(img, points, resize_factor):
-    result = img.copy()
+def draw_landmarks(img, points, resize_factor=1):
+    if resize_factor != 1:
+        points = np.asarray(points, dtype=np.float32) / resize_factor
+    points = np.asarray(points, dtype=int).tolist()
     for face_points in points:
-        for point in face_points:
-            point = (int(point[0] / resize_factor), int(
-                point[1] / resize_factor))
-            cv2.circle(result, point, 3, (0, 255, 0), -1)
-    return result
+        for x, y in face_points:
+            cv2.circle(img, (x, y), 3, (0, 255, 0), -1)
+
+
+## Helper Function to scale detection results to the original image size
+#
+#  @param bbs An array of bounding boxes of a face as (x1, y1, x2, y2).
+#  @param points An array containing arrays of feature points of a face
+#  @resize_factor factor the image was scaled with before detection.
+#  @return Bounding boxes and feature points in original image coordinates as int arrays.
+def scale_detections(bbs, points, resize_factor):
+    bbs = (np.asarray(bbs) / resize_factor).round().astype(int)
+    points = (np.asarray(points) / resize_factor).round().astype(int)
+    return bbs, points
+
+
+## Helper Function to calculate the area of bounding boxes
+#
+#  @param bbs An array of bounding boxes of a face as (x1, y1, x2, y2).
+#  @return Array containing the area of each bounding box.
+def get_face_areas(bbs):
+    bbs = np.asarray(bbs).reshape(-1, 4)
+    return (bbs[:, 2] - bbs[:, 0]) * (bbs[:, 3] - bbs[:, 1])
 
 
 ## Returns the closest face of all detected faces
 #
 #  Current implementation uses bounding box size to compare proximity
-#  @param bbs An array of bounding boxes of a face as tuple (x1, y1, x2, y2).
+#  @param bbs An array of bounding boxes of a face as (x1, y1, x2, y2).
 #  @return The array index of the biggest bounding box.
 def get_closest_face(bbs):
-    i = 0
-    max_id = 0
-    face_area = 0
-    for left, top, right, bottom in bbs:
-        tmp_face_area = (right - left) * (bottom - top)
-        if (tmp_face_area > face_area):
-            max_id = i
-            face_area = tmp_face_area
-        i += 1
-    return max_id
+    return int(get_face_areas(bbs).argmax())
 
 
 ## Checks whether a face is visible within certain distance
 #
 #  Current implementation uses bounding box to check for proximity. 
 #  Key value defined in FACE_AREA.
-#  @param bbs An array of bounding boxes of a face as tuple (x1, y1, x2, y2).
+#  @param bbs An array of bounding boxes of a face as (x1, y1, x2, y2).
 #  @return True if a face is close enough, False otherwise
 def face_detected(bbs):
-    face_area = 0
-    for left, top, right, bottom in bbs:
-        tmp_face_area = (right - left) * (bottom - top)
-        if (tmp_face_area > face_area):
-            face_area = tmp_face_area
-    if (face_area > FACE_AREA):
-        return True
-    else:
-        return False
+    face_areas = get_face_areas(bbs)
+    return bool(face_areas.size > 0 and face_areas.max() > FACE_AREA)
+
+
+## Function to load the reference embeddings for face recognition
+#
+#  TODO: To be moved into other module
+#  Flattens the per person embeddings into one matrix and L2-normalizes every row, so the
+#  similarity to all known faces can be computed with a single matrix-vector product.
+#  @param reps_file File containing a list of 128D embeddings for each person
+#  @param names_file File containing the name of each person
+#  @return Returns the normalized embeddings (N x 128) and the name belonging to each row.
+def load_reference_embeddings(reps_file, names_file):
+    people_reps = np.load(reps_file, allow_pickle=True)
+    people_names = np.load(names_file)
+    ref_reps = []
+    ref_names = []
+    for person in range(len(people_reps)):
+        for rep in people_reps[person]:
+            ref_reps.append(rep)
+            ref_names.append(people_names[person])
+    ref_reps = np.asarray(ref_reps, dtype=np.float32)
+    ref_reps /= np.linalg.norm(ref_reps, axis=1, keepdims=True)
+    return ref_reps, np.asarray(ref_names)
+
+
+## Function to calculate the 128D embeddings of a face with the quantized FaceNet
+#
+#  @face_img The cropped image of the face region.
+#  @param facenet The tflite interpreter with the quantized FaceNet as returned by load_quantized_facenet
+#  @return Returns the 128D embeddings.
+def calculate_embedding(face_img, facenet):
+    input_details = facenet.get_input_details()[0]
+    facenet.set_tensor(input_details['index'],
+                       np.expand_dims(face_img, 0).astype(
+                           input_details['dtype']))
+    facenet.invoke()
+    return facenet.get_tensor(facenet.get_output_details()[0]['index'])[0]
 
 
 ## Identifies a face using Facenet
@@ -157,35 +283,83 @@ def face_detected(bbs):
 #  TODO: To be moved into other module
 #  The function calculates the 128D embeddings of a given face using facenet in this implementation:
 #  https://github.com/davidsandberg/facenet
-#  Then the embeddings are run through a SVM classifier to identify the face. 
+#  Then the face is identified as the known face with the smallest L2 distance between the embeddings,
+#  which for normalized embeddings is the one with the largest dot product.
 #  @face_img The cropped image of the face region.
-#  @param session The tensorflow session with FaceNet already loaded
-#  @param classifier The SVM classifier already loaded
+#  @param facenet The tflite interpreter with the quantized FaceNet as returned by load_quantized_facenet
+#  @param ref_reps The normalized reference embeddings as returned by load_reference_embeddings
+#  @param ref_names The name belonging to each reference embedding
 #  @return Return the name of the face.
-def recognize_face(face_img, session, classifier):
+def recognize_face(face_img, facenet, ref_reps, ref_names):
 
     # calculate 128D embeddings
-    feed_dict = {
-        image_batch: np.expand_dims(face_img, 0),
-        phase_train_placeholder: False
-    }
-    rep = session.run(embeddings, feed_dict=feed_dict)[0]
-
-    # get class probabilities using SVM classifier
-    probabilities = classifier.predict_proba(rep.reshape(1, -1))
+    rep = calculate_embedding(face_img, facenet)
+    rep = rep / np.linalg.norm(rep)
 
-    # Calculate most likely class
-    out = np.argmax(probabilities[0])
+    # Calculate most similar reference embedding
+    similarities = np.dot(ref_reps, rep)
+    out = int(np.argmax(similarities))
+    similarity = similarities[out]
 
     # Retrieve class name
-    names = np.load('models/own_embeddings/own_names.npy')
-    face_name = names[out]
+    face_name = ref_names[out]
 
-    print('classification: ' + face_name + ' probability: ' +
-          probabilities[0][out])
+    print('classification: ' + face_name + ' similarity: ' +
+          str(similarity))
     return face_name
 
 
+## Function to request face recognition from another thread
+#
+#  TODO: To be called by the ros service handler for face recognition
+#  Asks the main loop to recognize the closest face and blocks until the result is available,
+#  so the caller is woken up as soon as inference is done instead of polling for it.
+#  Every request gets its own reply queue, so a late answer to a request that timed out is never
+#  returned to a later request.
+#  @param timeout Maximum time in seconds to wait for the result, None waits forever
+#  @return Returns the name of the face or None if no face was visible, recognition failed or the
+#          result did not arrive in time.
+def request_face_recognition(timeout=None):
+    reply = queue.Queue(maxsize=1)
+    recognition_requests.put(reply)
+    try:
+        return reply.get(timeout=timeout)
+    except queue.Empty:
+        return None
+
+
+## Helper Function to collect all pending face recognition requests
+#
+#  @return Returns the list of reply queues of all pending requests.
+def get_recognition_requests():
+    replies = []
+    while True:
+        try:
+            replies.append(recognition_requests.get_nowait())
+        except queue.Empty:
+            return replies
+
+
+## Function to answer face recognition requests
+#
+#  Runs recognize_face and passes the result to the threads waiting in request_face_recognition.
+#  If recognition fails, the error is printed and None is passed, so the waiting threads are not blocked.
+#  @param replies The reply queues of the requests as returned by get_recognition_requests
+#  @face_img The cropped image of the face region.
+#  @param facenet The tflite interpreter with the quantized FaceNet as returned by load_quantized_facenet
+#  @param ref_reps The normalized reference embeddings as returned by load_reference_embeddings
+#  @param ref_names The name belonging to each reference embedding
+def answer_recognition_requests(replies, face_img, facenet, ref_reps,
+                                ref_names):
+    try:
+        face_name = recognize_face(face_img, facenet, ref_reps, ref_names)
+    except Exception:
+        traceback.print_exc()
+        face_name = None
+    for reply in replies:
+        reply.put(face_name)
+
+
 ## Function to load a tensorflow model
 #
 #  TODO: To be moved into other module
@@ -196,9 +370,10 @@ def recognize_face(face_img, session, classifier):
 def load_model(model_dir, model_meta, model_content):
     session = tf.InteractiveSession()
     model_dir_exp = os.path.expanduser(model_dir)
-    saver = tf.train.import_meta_graph(os.path.join(model_dir_exp, meta_file))
+    saver = tf.train.import_meta_graph(
+        os.path.join(model_dir_exp, model_meta))
     saver.restore(tf.get_default_session(),
-                  os.path.join(model_dir_exp, ckpt_file))
+                  os.path.join(model_dir_exp, model_content))
     tf.get_default_graph().as_graph_def()
     return session
 
@@ -211,7 +386,17 @@ def load_model(model_dir, model_meta, model_content):
 #  @return Returns meta_file and checkpoint
 def get_model_filenames(model_dir):
     files = os.listdir(model_dir)
-    meta_files = [s for s in files if s.endswith('.meta')]
+    meta_files = []
+    max_step = -1
+    for f in files:
+        if f.endswith('.meta'):
+            meta_files.append(f)
+        step_str = CKPT_FILE_PATTERN.match(f)
+        if step_str is not None:
+            step = int(step_str.group(2))
+            if step > max_step:
+                max_step = step
+                ckpt_file = step_str.group(1)
     if len(meta_files) == 0:
         raise ValueError(
             'No meta file found in the model directory (%s)' % model_dir)
@@ -220,21 +405,262 @@ def get_model_filenames(model_dir):
             'There should not be more than one meta file in the model directory (%s)'
             % model_dir)
     meta_file = meta_files[0]
-    meta_files = [s for s in files if '.ckpt' in s]
-    max_step = -1
-    for f in files:
-        step_str = re.match(r'(^model-[\w\- ]+.ckpt-(\d+))', f)
-        if step_str is not None and len(step_str.groups()) >= 2:
-            step = int(step_str.groups()[1])
-            if step > max_step:
-                max_step = step
-                ckpt_file = step_str.groups()[0]
     return meta_file, ckpt_file
 
 
+## Function to quantize FaceNet for faster inference
+#
+#  TODO: To be moved into other module
+#  Freezes the loaded FaceNet graph for a single face in inference mode and converts it to a tflite
+#  model with 8 bit weights. If representative face images are given, the activations are
+#  calibrated and quantized to 8 bit as well.
+#  @param session The tensorflow session with FaceNet already loaded
+#  @param representative_faces Optional list of cropped face images used for calibration
+#  @return Returns the quantized FaceNet as tflite model
+def quantize_facenet(session, representative_faces=None):
+    frozen_graph = tf.graph_util.convert_variables_to_constants(
+        session, session.graph.as_graph_def(), ['embeddings'])
+    with tf.Graph().as_default() as graph:
+        image = tf.placeholder(
+            tf.float32, shape=(1, EXPECT_SIZE, EXPECT_SIZE, 3), name='image')
+        tf.import_graph_def(
+            frozen_graph,
+            input_map={'input:0': image,
+                       'phase_train:0': tf.constant(False)},
+            name='')
+        with tf.Session(graph=graph) as frozen_session:
+            converter = tf.lite.TFLiteConverter.from_session(
+                frozen_session, [image],
+                [graph.get_tensor_by_name('embeddings:0')])
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            if representative_faces is not None:
+                converter.representative_dataset = lambda: (
+                    [np.expand_dims(face, 0).astype(np.float32)]
+                    for face in representative_faces)
+            tflite_model = converter.convert()
+    return tflite_model
+
+
+## Function to compare the quantized FaceNet with the original one
+#
+#  TODO: To be moved into other module
+#  @param session The tensorflow session with FaceNet already loaded
+#  @param facenet The tflite interpreter with the quantized FaceNet
+#  @param check_faces List of cropped face images
+#  @return Returns the minimum cosine similarity of the embeddings of both models.
+def check_quantized_facenet(session, facenet, check_faces):
+    graph = session.graph
+    image_batch = graph.get_tensor_by_name("input:0")
+    phase_train_placeholder = graph.get_tensor_by_name("phase_train:0")
+    embeddings = graph.get_tensor_by_name("embeddings:0")
+    min_similarity = 1.0
+    for face_img in check_faces:
+        feed_dict = {
+            image_batch: np.expand_dims(face_img, 0),
+            phase_train_placeholder: False
+        }
+        rep = session.run(embeddings, feed_dict=feed_dict)[0]
+        quantized_rep = calculate_embedding(face_img, facenet)
+        similarity = np.dot(rep, quantized_rep) / (
+            np.linalg.norm(rep) * np.linalg.norm(quantized_rep))
+        min_similarity = min(min_similarity, similarity)
+    return min_similarity
+
+
+## Function to load the quantized FaceNet
+#
+#  TODO: To be moved into other module
+#  Loads the cached tflite model from FACENET_TFLITE_FILE. If there is none yet, the FaceNet checkpoint
+#  is quantized once, checked against the original model on the faces in check_image_dir and stored
+#  in the cache.
+#  @param model_dir Path where the FaceNet checkpoint is stored
+#  @param check_image_dir Directory of face images used to compare quantized and original model
+#  @return Returns a tflite interpreter running the quantized FaceNet
+def load_quantized_facenet(model_dir, check_image_dir):
+    if not os.path.exists(FACENET_TFLITE_FILE):
+        print('Quantizing Facenet...')
+        check_faces = load_faces(check_image_dir)
+        if len(check_faces) == 0:
+            raise ValueError(
+                'No faces found to check the quantized FaceNet (%s)' %
+                check_image_dir)
+        meta_file, ckpt_file = get_model_filenames(
+            os.path.expanduser(model_dir))
+        session = load_model(model_dir, meta_file, ckpt_file)
+        tflite_model = quantize_facenet(session)
+        facenet = tf.lite.Interpreter(model_content=tflite_model)
+        facenet.allocate_tensors()
+        similarity = check_quantized_facenet(session, facenet, check_faces)
+        session.close()
+        print('similarity of quantized embeddings: ' + str(similarity))
+        if similarity < QUANTIZATION_MIN_SIMILARITY:
+            raise ValueError(
+                'Quantized FaceNet differs too much from the original model (similarity %f)'
+                % similarity)
+        with open(FACENET_TFLITE_FILE, 'wb') as tflite_file:
+            tflite_file.write(tflite_model)
+    facenet = tf.lite.Interpreter(model_path=FACENET_TFLITE_FILE)
+    facenet.allocate_tensors()
+    return facenet
+
+
+## Helper Function to load face images
+#
+#  Detects the closest face in every image of a directory and aligns it.
+#  @param image_dir Directory containing the images
+#  @return Returns a list of the cropped face images.
+def load_faces(image_dir):
+    faces = []
+    for image_file in sorted(os.listdir(image_dir)):
+        img = cv2.imread(os.path.join(image_dir, image_file))
+        if img is None:
+            continue
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        total_boxes, points = detect_face_and_landmarks_mtcnn(img)
+        if len(total_boxes) > 0:
+            faces.append(
+                align_face_mtcnn(img,
+                                 total_boxes[get_closest_face(total_boxes)]))
+    return faces
+
+
+## Helper Function to hand over data between pipeline stages
+#
+#  Puts an item into a bounded queue. If the queue is full the oldest item is dropped,
+#  so the next stage always works on the most recent frame instead of a stale one.
+#  @param q The queue connecting two pipeline stages
+#  @param item The item to be passed to the next stage
+def put_latest(q, item):
+    try:
+        q.put_nowait(item)
+    except queue.Full:
+        try:
+            q.get_nowait()
+        except queue.Empty:
+            pass
+        q.put_nowait(item)
+
+
+## Helper Function to receive data from the previous pipeline stage
+#
+#  Re-raises an exception forwarded by the previous stage, see run_stage.
+#  @param q The queue connecting two pipeline stages
+#  @param block Wait for an item if True, raise queue.Empty otherwise
+#  @return The item passed by the previous stage
+def get_checked(q, block=True):
+    item = q.get(block)
+    if isinstance(item, Exception):
+        raise item
+    return item
+
+
+## Helper Function to run a pipeline stage in its own thread
+#
+#  If the stage fails, the exception is passed on through its output queue instead of silently ending
+#  the thread, so the next stage raises it rather than waiting forever.
+#  @param stage The pipeline stage function
+#  @param output The output queue of the stage
+#  @param args The arguments of the stage
+def run_stage(stage, output, *args):
+    try:
+        stage(*args)
+    except Exception as error:
+        put_latest(output, error)
+
+
+## Pipeline stage to grab frames from the realsense camera
+#
+#  Waits for new frames and resizes the RGB color image with resize_factor for faster processing.
+#  MTCNN expects RGB input, so only the full size image used for display is converted to BGR.
+#  Runs in its own thread.
+#  @param dev The realsense device
+#  @param frames Output queue receiving tuples (c, img)
+def capture_frames(dev, frames):
+    while True:
+        # Get frame from realsense
+        dev.wait_for_frame()
+        # color image (RGB), fetched once since every access copies the frame
+        colour = dev.colour
+        c = cv2.cvtColor(colour, cv2.COLOR_RGB2BGR)
+
+        #resize images for faster processing with resize_factor
+        img = cv2.resize(colour, (int(resize_factor * x_pixel), int(
+            resize_factor * y_pixel)))
+
+        put_latest(frames, (c, img))
+
+
+## Pipeline stage to run face detection
+#
+#  Runs MTCNN on the frames delivered by capture_frames. All frames queued up while the previous
+#  batch was processed (up to MTCNN_BATCH_SIZE) are handled in order.
+#  MTCNN only runs every DETECTION_INTERVAL frames or when a face is lost, the faces are tracked on
+#  the frames in between and the landmarks are moved along with their bounding box.
+#  Without tracking (DETECTION_INTERVAL of 1) the whole batch is run through MTCNN at once, and
+#  MTCNN already runs on the next batch while the results of the previous one are passed on.
+#  Runs in its own thread, tensorflow releases the GIL during inference so capturing and drawing
+#  continue meanwhile.
+#  @param frames Input queue delivering tuples (c, img)
+#  @param detections Output queue receiving tuples (c, img, boxes, display_boxes, display_points),
+#         the display boxes and points are scaled to the size of c
+def detect_faces(frames, detections):
+    trackers = None
+    frames_tracked = 0
+    total_boxes, points = convert_mtcnn_result([], [])
+    # batch whose MTCNN results are not passed on yet, only used without tracking
+    pending = None
+    mtcnn_executor = ThreadPoolExecutor(max_workers=2)
+    while True:
+        # wait for one frame, then take whatever else is already queued
+        batch = [get_checked(frames)]
+        while len(batch) < MTCNN_BATCH_SIZE:
+            try:
+                batch.append(get_checked(frames, False))
+            except queue.Empty:
+                break
+
+        if DETECTION_INTERVAL == 1:
+            # Detect and align faces using MTCNN on all frames at once, no frame depends on the
+            # previous one, so this batch is started before the previous results are passed on
+            future = mtcnn_executor.submit(
+                detect_face_and_landmarks_mtcnn_bulk,
+                [img for c, img in batch])
+            if pending is not None:
+                pending_batch, pending_future = pending
+                for (c, img), (total_boxes, points) in zip(
+                        pending_batch, pending_future.result()):
+                    put_latest(detections, (c, img, total_boxes) +
+                               scale_detections(total_boxes, points,
+                                                resize_factor))
+            pending = (batch, future)
+            continue
+
+        for c, img in batch:
+            # Track faces detected in a previous frame until the next detection is due,
+            # without any faces MTCNN runs on every frame so new faces are found right away
+            tracked_boxes = None
+            if trackers and frames_tracked < DETECTION_INTERVAL - 1:
+                tracked_boxes = track_faces(img, trackers, total_boxes)
+
+            if tracked_boxes is None:
+                # Detect and align faces using MTCNN, then track them from here on
+                total_boxes, points = detect_face_and_landmarks_mtcnn(img)
+                trackers = create_face_trackers(img, total_boxes)
+                frames_tracked = 0
+            else:
+                # the box size is kept, so the shift of the corner is the shift of the center
+                points = points + (tracked_boxes - total_boxes)[:, None, 0:2]
+                total_boxes = tracked_boxes
+                frames_tracked += 1
+
+            put_latest(detections, (c, img, total_boxes) + scale_detections(
+                total_boxes, points, resize_factor))
+
+
 ## Entry Point to run face detection.
 #
-#  Loads all data and processes realsense camera input in a loop.
+#  Loads all data and processes realsense camera input in a pipeline: one thread captures frames,
+#  one thread runs face detection and the main thread draws and shows the results.
 if __name__ == '__main__':
 
     # start pyrealsense service
@@ -271,46 +697,45 @@ if __name__ == '__main__':
 
     # Init Facenet for face recognition
     print('Initializing Facenet...')
-    tree_model = "models/Tree/own.mod"
-    svm_model = "models/SVM/svm_lfw.mod"
-    clf = pickle.load(open(tree_model, "rb"))
-    model_dir = 'models/facenet'
-    meta_file, ckpt_file = get_model_filenames(os.path.expanduser(model_dir))
-    session = load_model(model_dir, meta_file, ckpt_file)
-    graph = tf.get_default_graph()
-    image_batch = graph.get_tensor_by_name("input:0")
-    phase_train_placeholder = graph.get_tensor_by_name("phase_train:0")
-    embeddings = graph.get_tensor_by_name("embeddings:0")
+    ref_reps, ref_names = load_reference_embeddings(
+        'models/own_embeddings/own_reps.npy',
+        'models/own_embeddings/own_names.npy')
+    facenet = load_quantized_facenet('models/facenet', 'test_imgs')
+    # single worker, the tflite interpreter must not be invoked concurrently
+    recognition_executor = ThreadPoolExecutor(max_workers=1)
     print('done.')
 
     print('Starting detection...')
+    # bounded queues between the stages so stale frames get dropped,
+    # frames only queue up for a batch if tracking is disabled
+    frames = queue.Queue(
+        maxsize=MTCNN_BATCH_SIZE if DETECTION_INTERVAL == 1 else 1)
+    detections = queue.Queue(maxsize=1)
+    for stage, output, args in ((capture_frames, frames, (dev, frames)),
+                                (detect_faces, detections,
+                                 (frames, detections))):
+        worker = threading.Thread(
+            target=run_stage, args=(stage, output) + args)
+        worker.daemon = True
+        worker.start()
+
+    # show detection results, imshow has to run in the main thread
+    # (errors of the worker threads are raised here)
     while True:
-        # Get frame from realsense
-        dev.wait_for_frame()
-        # color image  
-        c = cv2.cvtColor(dev.colour, cv2.COLOR_RGB2BGR)
-        #depth images
-        d = dev.depth * dev.depth_scale * 1000
-
-        #resize images for faster processing with resize_factor
-        img = cv2.resize(c, (int(resize_factor * x_pixel), int(
-            resize_factor * y_pixel)))
-
-        d_img = cv2.resize(d, (int(resize_factor * x_pixel), int(
-            resize_factor * y_pixel)))
-        d_img = cv2.applyColorMap(d.astype(np.uint8), cv2.COLORMAP_RAINBOW)
-
-        # Detect and align faces using MTCNN
-        total_boxes, points = detect_face_and_landmarks_mtcnn(img)
+        c, img, total_boxes, display_boxes, display_points = get_checked(
+            detections)
 
         # If no faces were found (= no bounding boxes) just show frame and continie loop
-        if len(total_boxes) is 0:
+        if len(total_boxes) == 0:
             no_face_detect_counter += 1
             if no_face_detect_counter > 3:
                 face_nearby = False
+            # no face to recognize, answer pending requests right away
+            for reply in get_recognition_requests():
+                reply.put(None)
             # show image and continue
             cv2.imshow("detection result", c)
-            cv2.waitKey(10)
+            cv2.waitKey(1)
             continue
 
         # Check if faces nearby
@@ -321,21 +746,23 @@ if __name__ == '__main__':
             if no_face_detect_counter > 3:
                 face_nearby = False
 
-        # TODO: Trigger Face Recognition only on service request
-        start_recognize_face = false
-        if start_recognize_face:
-            start_new_thread(recognize_face, (align_face_mtcnn(
-                img, total_boxes[get_closest_face(total_boxes)]), session,
-                                              clf, ))
+        # Trigger Face Recognition only on request
+        replies = get_recognition_requests()
+        if replies:
+            recognition_executor.submit(
+                answer_recognition_requests, replies,
+                align_face_mtcnn(img,
+                                 total_boxes[get_closest_face(total_boxes)]),
+                facenet, ref_reps, ref_names)
 
         # TODO:
         # - create ros service returning face_nearby
-        # - create ros service calling recognize_face(face_img, session, classifier) and returning classification result
+        # - create ros service calling request_face_recognition() and returning classification result
 
-        #Show detection result
-        draw = draw_rects(c.copy(), total_boxes, resize_factor)
-        draw = draw_landmarks(draw, points, resize_factor)
-        cv2.imshow("detection result", draw)
+        #Show detection result (the frame is not used afterwards, so draw on it directly)
+        draw_rects(c, display_boxes)
+        draw_landmarks(c, display_points)
+        cv2.imshow("detection result", c)
 
-        #WAIT
-        cv2.waitKey(10)
+        #WAIT (only long enough to process GUI events)
+        cv2.waitKey(1)